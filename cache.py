@@ -0,0 +1,59 @@
+from collections import OrderedDict
+
+DEFAULT_CACHE_SIZE = 64 * 2**20  # bytes of piece data kept in memory
+
+
+# keeps whole pieces in memory so consecutive block requests for the same
+# piece, and popular pieces requested by many peers, don't go to disk
+class PieceCache:
+    def __init__(self, filewriter, max_size=DEFAULT_CACHE_SIZE):
+        self.filewriter = filewriter
+        self.max_size = max_size
+        self.size = 0  # bytes currently cached
+        self.pieces = OrderedDict()  # piece index -> memoryview, oldest first
+        self.hits = 0
+        self.misses = 0
+
+    def piece_size(self, index):
+        piece_length = self.filewriter.piece_length
+        return min(piece_length, self.filewriter.total_size - index * piece_length)
+
+    # returns None for a block that lies outside the torrent, or in a
+    # piece that hasn't passed its hash check yet
+    def read(self, index, begin, length):
+        if index >= len(self.filewriter.pieces) or not self.filewriter.pieces[index]:
+            return None
+        if begin + length > self.piece_size(index):
+            return None
+        piece = self.pieces.get(index)
+        if piece is None:
+            self.misses += 1
+            # read ahead the whole piece, the peer will ask for the rest soon
+            piece = memoryview(
+                self.filewriter.read_piece(index, 0, self.piece_size(index))
+            )
+            self.insert(index, piece)
+        else:
+            self.hits += 1
+            self.pieces.move_to_end(index)  # most recently used
+        return piece[begin : begin + length]
+
+    def insert(self, index, piece):
+        if len(piece) > self.max_size:
+            return  # would evict everything and still not fit
+        self.pieces[index] = piece
+        self.size += len(piece)
+        while self.size > self.max_size:
+            _, evicted = self.pieces.popitem(last=False)  # least recently used
+            self.size -= len(evicted)
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0
+
+    def stats(self):
+        return (
+            f"{self.hits} hits, {self.misses} misses, "
+            f"{self.hit_rate() * 100:.1f}% hit rate, "
+            f"{len(self.pieces)} pieces ({self.size} bytes) cached"
+        )
@@ -1,13 +1,59 @@
 from torrent import Torrent
+from profiling import spans, LoopLagWatchdog, Profiler
+import argparse
 import asyncio
 
 
-async def main():
+async def main(args):
     # path = "./test_files/pg2600.txt.torrent"
     path = "./test_files/debian-11.6.0-amd64-netinst.iso.torrent"
     verbose = True  # if you want to allow stacktrace printing, set this to True
-    torrent = Torrent(path, verbose)
-    await torrent.start_connections()
+    # parsed metadata is kept here so reloading the same torrent is instant
+    metadata_cache_dir = "./.metadata_cache"
 
+    # profiling is off unless asked for on the command line
+    if args.spans:
+        spans.enable(args.spans)
+    tasks = []
+    if args.loop_lag_ms:
+        watchdog = LoopLagWatchdog(args.loop_lag_ms / 1000, args.loop_lag_log)
+        tasks.append(watchdog.start())
+    profiler = Profiler(args.profile_mode)
+    profiler.install_signal_handler()  # kill -USR1 <pid> starts/stops a capture
+    if args.profile_seconds:
+        tasks.append(profiler.capture_for(args.profile_seconds))
 
-asyncio.run(main())
+    torrent = Torrent(path, verbose, metadata_cache_dir=metadata_cache_dir)
+    try:
+        await asyncio.gather(torrent.start_connections(), *tasks)
+    finally:
+        await torrent.stop()  # sends the stopped announce
+        profiler.stop()  # writes out a capture that is still running
+        spans.close()
+
+
+# Parse command line arguments
+parser = argparse.ArgumentParser(description="Quentin Tarantino.")
+parser.add_argument(
+    "--spans", type=str, help="Write per-stage timing spans to this file"
+)
+parser.add_argument(
+    "--loop-lag-ms",
+    type=float,
+    help="Dump the stack when the event loop is blocked for this long",
+)
+parser.add_argument(
+    "--loop-lag-log", type=str, help="Also append loop lag stack dumps to this file"
+)
+parser.add_argument(
+    "--profile-mode",
+    choices=["cprofile", "sample"],
+    default="cprofile",
+    help="What a capture uses, for --profile-seconds and SIGUSR1",
+)
+parser.add_argument(
+    "--profile-seconds", type=float, help="Capture a profile for the first N seconds"
+)
+args = parser.parse_args()
+
+asyncio.run(main(args))
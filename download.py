@@ -3,10 +3,13 @@ import heapq
 import hashlib
 import random
 from utils import pretty_print
+from profiling import span
 import time
 import asyncio
 
 BLOCK_LENGTH = 2**14
+# a peer slower than this fraction of the average peer rate is considered slow
+SLOW_PEER_FACTOR = 0.5
 
 
 class DownloadHandler:
@@ -15,6 +18,7 @@ class DownloadHandler:
         self.needed_pieces = []
         self.pending_pieces = []
         self.finished_pieces = []
+        self.done = False
         self.torrent = torrent
         self.start_time = time.time()  # record the start time of the download
         self.total_size = torrent.tracker.length  # total file size
@@ -26,7 +30,7 @@ class DownloadHandler:
         piece_length = self.tracker.piece_length
         for piece_num in range(0, self.tracker.num_pieces):
             hash = self.tracker.pieces[(20 * piece_num) : (20 * piece_num) + 20]
-            if piece_num < (self.tracker.blocks_per_piece - 1):
+            if piece_num < (self.tracker.num_pieces - 1):
                 piece = Piece(
                     hash, piece_length, self.tracker.blocks_per_piece, piece_num
                 )
@@ -65,24 +69,86 @@ class DownloadHandler:
         )  # calculate average speed in bytes/second
         return average_speed
 
-    def next(self, pieces):
-        if len(self.pending_pieces):
-            return self.pending_pieces.pop(0)
+    # a peer is slow if it is well below the average rate of the peers
+    # that are currently sending us data
+    def is_slow(self, peer):
+        rates = [
+            x.stats.rate()
+            for x in self.torrent.peer_list + self.torrent.web_seeds
+            if x is not peer and not x.snubbed and x.stats.rate() > 0
+        ]
+        if not rates:
+            return False
+        return peer.stats.rate() < SLOW_PEER_FACTOR * (sum(rates) / len(rates))
+
+    def next(self, pieces, peer=None):
+        with span("pick"):
+            return self.pick(pieces, peer)
+
+    def pick(self, pieces, peer):
+        slow = peer is not None and self.is_slow(peer)
+        # pending pieces were abandoned by another peer, so they go to the
+        # first peer that has them, unless it is a slow one
+        if not slow:
+            for piece in self.pending_pieces:
+                if piece.index in pieces:
+                    self.pending_pieces.remove(piece)
+                    return piece
         filtered = [x for x in self.needed_pieces if x[0].index in pieces]
         if len(filtered) == 0:
+            if slow:
+                for piece in self.pending_pieces:
+                    if piece.index in pieces:
+                        self.pending_pieces.remove(piece)
+                        return piece
             return None
-        top = min(filtered, key=lambda x: x[1])  # pick highest rarity
+        if slow:
+            # slow peers take the most common pieces so they never hold up
+            # a rare one that only a few peers can provide
+            top = max(filtered, key=lambda x: x[1])
+        else:
+            top = min(filtered, key=lambda x: x[1])  # pick highest rarity
         self.needed_pieces.remove(top)
         return top[0]
 
+    # hands a piece from a timed out request back to the pool and wakes up
+    # an idle peer that can finish it
+    def reissue(self, piece):
+        self.pending_pieces.append(piece)
+        for peer in self.torrent.peer_list:
+            if (
+                peer.writer
+                and peer.unchoked
+                and not peer.waiting
+                and not peer.snubbed
+                and piece.index in peer.pieces
+            ):
+                asyncio.ensure_future(peer.wake())
+                break
+
+    # checks a fully downloaded piece against the hash from the torrent file,
+    # a bad piece goes back to the pool to be downloaded again
+    def verify_piece(self, piece):
+        digest = piece.actual_hash.digest()
+        if digest != piece.hash:
+            print("Incorrect hash.")
+            piece.reset()
+            self.pending_pieces.append(piece)
+            return False
+        self.finished_pieces.append(piece)
+        self.torrent.left -= piece.length
+        self.torrent.filewriter.mark_verified(piece.index)
+        self.torrent.send_have(piece.index)
+        self.check_done()
+        return True
+
     def check_done(self):
-        if (
-            len(self.pending_pieces)
-            or len(self.needed_pieces)
-            or len([x for x in self.torrent.peer_list if x.waiting])
-        ):
-            return
+        if self.done:
+            return True
+        if len(self.finished_pieces) < self.tracker.num_pieces:
+            return False
 
+        self.done = True
         avg_speed = self.get_avg_speed()
         pretty_print("DOWNLOAD FINISHED 🥳🥳🥳", "green")
 
@@ -94,6 +160,8 @@ class DownloadHandler:
         pretty_print(
             f"Average download speed: {self.format_size(avg_speed)}/s", "green"
         )
+        self.torrent.on_complete()
+        return True
 
 
 class Piece:
@@ -106,8 +174,13 @@ class Piece:
         self.length = length
         self.num_blocks = num_blocks
 
+    # drops everything downloaded so far, e.g. after a failed hash check
+    def reset(self):
+        self.offset = 0
+        self.actual_hash = hashlib.sha1()
+
     def next_block_length(self):
-        if self.offset + BLOCK_LENGTH <= self.num_blocks * BLOCK_LENGTH:
+        if self.offset + BLOCK_LENGTH <= self.length:
             return BLOCK_LENGTH
         elif self.length - self.offset > 0:
             return self.length - self.offset
@@ -116,24 +189,30 @@ class Piece:
 
 
 class FileWriter:
-    def __init__(self, filename, torrent):
+    def __init__(self, filename, torrent, existing=False):
         self.filename = filename
         pretty_print(f"NAME OF FILE: {filename}", "green")
 
         self.total_size = torrent.tracker.length
         self.piece_length = torrent.tracker.piece_length
-        self.file = open(filename, "wb")
+        # an existing file is already complete and only gets seeded
+        self.file = open(filename, "rb+" if existing else "wb")
         self.torrent = torrent
         self.pieces = [
-            False for _ in range(-(-self.total_size // self.piece_length))
+            existing for _ in range(-(-self.total_size // self.piece_length))
         ]  # ceil division
         # total_size // piece_length
 
     def write_block(self, piece_index, block_index, block_data):
-        position = piece_index * self.piece_length + block_index
-        self.file.seek(position)
-        self.file.write(block_data)
-        self.pieces[piece_index] = True  # mark piece as downloaded
+        with span("write_block"):
+            position = piece_index * self.piece_length + block_index
+            self.file.seek(position)
+            self.file.write(block_data)
+
+    # the piece passed its hash check, so it can be uploaded
+    def mark_verified(self, piece_index):
+        self.file.flush()  # the seeder reads through its own file handle
+        self.pieces[piece_index] = True
 
     def read_piece(self, index, begin, length):
         # Open the file in binary mode
@@ -0,0 +1,46 @@
+import asyncio
+import argparse
+from torrent import Torrent
+from utils import pretty_print
+
+REPORT_INTERVAL = 10  # seconds between upload ratio reports
+
+
+# seeds an already complete file as the origin and reports how many bytes
+# the origin uploads per full copy that reaches the swarm; leechers upload
+# every piece they verify, so with --super-seed this heads towards one copy
+async def report(torrent):
+    while True:
+        await asyncio.sleep(REPORT_INTERVAL)
+        if torrent.seeder:
+            pretty_print(f"Origin: {torrent.seeder.upload_stats()}", "magenta")
+
+
+async def main(path, file_name, port, super_seed):
+    verbose = True
+    torrent = Torrent(
+        path,
+        verbose,
+        preferred_file_name=file_name,
+        seed_port=port,
+        seed_existing=True,
+        super_seed=super_seed,
+    )
+    try:
+        await asyncio.gather(torrent.start_connections(), report(torrent))
+    finally:
+        await torrent.stop()
+
+
+# Parse command line arguments
+parser = argparse.ArgumentParser(description="Quentin Tarantino origin seeder.")
+parser.add_argument("torrent", type=str, help="Path to the .torrent file")
+parser.add_argument("file", type=str, help="Path to the complete payload")
+parser.add_argument("--port", type=int, default=6886, help="Port to seed on")
+parser.add_argument(
+    "--super-seed", action="store_true", help="Use BEP 16 super-seeding"
+)
+args = parser.parse_args()
+
+# Run the main function
+asyncio.run(main(args.torrent, args.file, args.port, args.super_seed))
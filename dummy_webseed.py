@@ -0,0 +1,52 @@
+import argparse
+import os
+import re
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# a local stand-in for a BEP 19 web seed mirror: serves one file and
+# answers Range requests over keep-alive connections, which the plain
+# http.server file handler doesn't do
+class RangeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive
+    path_on_disk = None
+    stall = False  # never answer, to try out web seed timeouts
+
+    def do_GET(self):
+        if self.stall:
+            self.rfile.read()  # hold the connection until the client gives up
+            return
+        size = os.path.getsize(self.path_on_disk)
+        match = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if not match:
+            self.send_error(416, "Only single byte ranges are supported")
+            return
+        start = int(match[1])
+        end = min(int(match[2]) if match[2] else size - 1, size - 1)
+        if start > end:
+            self.send_error(416, "Range not satisfiable")
+            return
+        with open(self.path_on_disk, "rb") as f:
+            f.seek(start)
+            body = f.read(end - start + 1)
+        self.send_response(206)
+        self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+# Parse command line arguments
+parser = argparse.ArgumentParser(description="Quentin Tarantino web seed stand-in.")
+parser.add_argument("file", type=str, help="Path to the complete payload")
+parser.add_argument("--host", type=str, default="127.0.0.1", help="Address to bind")
+parser.add_argument("--port", type=int, default=8998, help="Port to serve on")
+parser.add_argument(
+    "--stall", action="store_true", help="Accept requests but never answer them"
+)
+args = parser.parse_args()
+
+RangeHandler.path_on_disk = args.file
+RangeHandler.stall = args.stall
+print(f"Serving {args.file} with Range support on {args.host}:{args.port}")
+ThreadingHTTPServer((args.host, args.port), RangeHandler).serve_forever()
@@ -0,0 +1,120 @@
+DICT = ord("d")
+LIST = ord("l")
+INT = ord("i")
+END = ord("e")
+COLON = ord(":")
+
+
+class BencodeError(Exception):
+    pass
+
+
+# returns the position right after the bencoded value starting at pos,
+# without decoding it
+def skip(data, pos):
+    kind = data[pos]
+    if kind == INT:
+        end = find(data, END, pos)
+        return end + 1
+    if kind == LIST or kind == DICT:
+        pos += 1
+        while data[pos] != END:
+            pos = skip(data, pos)
+        return pos + 1
+    start, end = string_span(data, pos)
+    return end
+
+
+# returns the (start, end) of the contents of the string starting at pos
+def string_span(data, pos):
+    colon = find(data, COLON, pos)
+    try:
+        length = int(bytes(data[pos:colon]))
+    except ValueError:
+        raise BencodeError(f"invalid string length at {pos}")
+    if colon + 1 + length > len(data):
+        raise BencodeError(f"string at {pos} runs past the end of the data")
+    return colon + 1, colon + 1 + length
+
+
+def find(data, byte, pos):
+    for i in range(pos, len(data)):
+        if data[i] == byte:
+            return i
+    raise BencodeError(f"unterminated value at {pos}")
+
+
+# decodes the value starting at pos, dicts are returned as LazyDicts
+def decode_at(data, pos):
+    kind = data[pos]
+    if kind == INT:
+        end = find(data, END, pos)
+        return int(bytes(data[pos + 1 : end])), end + 1
+    if kind == LIST:
+        items = []
+        pos += 1
+        while data[pos] != END:
+            item, pos = decode_at(data, pos)
+            items.append(item)
+        return items, pos + 1
+    if kind == DICT:
+        value = LazyDict(data, pos)
+        return value, value.end
+    start, end = string_span(data, pos)
+    return bytes(data[start:end]), end
+
+
+def decode(data):
+    value, _ = decode_at(memoryview(data), 0)
+    return value
+
+
+# a bencoded dict that only indexes where its values are and decodes
+# them the first time they are asked for
+class LazyDict:
+    def __init__(self, data, start=0):
+        self.data = data if isinstance(data, memoryview) else memoryview(data)
+        self.start = start
+        self.spans = {}  # key -> (start, end) of the encoded value
+        self.values = {}  # key -> already decoded value
+        if self.data[start] != DICT:
+            raise BencodeError(f"expected a dict at {start}")
+        pos = start + 1
+        while self.data[pos] != END:
+            key_start, key_end = string_span(self.data, pos)
+            value_end = skip(self.data, key_end)
+            self.spans[bytes(self.data[key_start:key_end])] = (key_end, value_end)
+            pos = value_end
+        self.end = pos + 1
+
+    def raw(self, key):
+        # the encoded value, e.g. to hash the info dict exactly as it was
+        start, end = self.spans[key]
+        return self.data[start:end]
+
+    def span(self, key):
+        # (start, end) of the contents of a string value within the data
+        return string_span(self.data, self.spans[key][0])
+
+    def view(self, key):
+        # zero-copy contents of a string value
+        start, end = self.span(key)
+        return self.data[start:end]
+
+    def get(self, key, default=None):
+        if key not in self.spans:
+            return default
+        if key not in self.values:
+            self.values[key], _ = decode_at(self.data, self.spans[key][0])
+        return self.values[key]
+
+    def __getitem__(self, key):
+        if key not in self.spans:
+            raise KeyError(key)
+        return self.get(key)
+
+    def __contains__(self, key):
+        return key in self.spans
+
+    def keys(self):
+        return self.spans.keys()
@@ -0,0 +1,105 @@
+import asyncio
+import random
+import socket
+import struct
+import time
+from utils import pretty_print
+
+# BEP 14 local service discovery
+LSD_GROUP = "239.192.152.143"
+LSD_PORT = 6771
+ANNOUNCE_INTERVAL = 5 * 60  # seconds between announces, as the BEP suggests
+REPLY_INTERVAL = 10  # at most one announce in reply to other peers this often
+
+
+class LocalServiceDiscovery(asyncio.DatagramProtocol):
+    def __init__(self, torrent):
+        self.torrent = torrent
+        self.transport = None
+        self.info_hash = torrent.tracker.info_hash.hex()
+        # lets us ignore our own announces, which multicast loops back to us
+        self.cookie = "".join([str(random.randint(0, 9)) for _ in range(12)])
+        self.last_announce = 0
+
+    def make_socket(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, "SO_REUSEPORT"):
+            # several clients on the same box all listen on the LSD port
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(("", LSD_PORT))
+        membership = struct.pack(
+            "4s4s", socket.inet_aton(LSD_GROUP), socket.inet_aton("0.0.0.0")
+        )
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+        sock.setblocking(False)
+        return sock
+
+    def make_announce(self):
+        return (
+            "BT-SEARCH * HTTP/1.1\r\n"
+            + f"Host: {LSD_GROUP}:{LSD_PORT}\r\n"
+            + f"Port: {self.torrent.seed_port}\r\n"
+            + f"Infohash: {self.info_hash}\r\n"
+            + f"cookie: {self.cookie}\r\n"
+            + "\r\n\r\n"
+        ).encode("utf-8")
+
+    async def start(self):
+        if self.torrent.tracker.private:
+            # BEP 27: private torrents only get peers from the tracker
+            pretty_print("Private torrent, local service discovery is off", "cyan")
+            return
+        loop = asyncio.get_running_loop()
+        await loop.create_datagram_endpoint(lambda: self, sock=self.make_socket())
+        pretty_print(f"Local service discovery on {LSD_GROUP}:{LSD_PORT}", "cyan")
+        # until the seeder accepts connections we only listen, announcing
+        # our port before that just sends every local peer to a closed port
+        await self.torrent.listening.wait()
+        while True:
+            self.announce()
+            await asyncio.sleep(ANNOUNCE_INTERVAL)
+
+    def announce(self):
+        self.last_announce = time.monotonic()
+        self.transport.sendto(self.make_announce(), (LSD_GROUP, LSD_PORT))
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        try:
+            lines = data.decode("utf-8").split("\r\n")
+        except UnicodeDecodeError:
+            return
+        if not lines[0].startswith("BT-SEARCH"):
+            return
+        port = None
+        cookie = None
+        info_hashes = []
+        for line in lines[1:]:
+            if ":" not in line:
+                continue
+            key, value = line.split(":", 1)
+            key = key.strip().lower()
+            value = value.strip()
+            if key == "port":
+                port = value
+            elif key == "infohash":
+                info_hashes.append(value.lower())  # may be repeated
+            elif key == "cookie":
+                cookie = value
+        if cookie == self.cookie or self.info_hash not in info_hashes:
+            return
+        if port is None or not port.isdigit():
+            return
+        if (
+            self.torrent.listening.is_set()
+            and time.monotonic() - self.last_announce > REPLY_INTERVAL
+        ):
+            # answer so a peer that just started doesn't wait for our
+            # next periodic announce to find us
+            self.announce()
+        if self.torrent.add_peer(addr[0], int(port)):
+            pretty_print(f"Found local peer {addr[0]}:{port}", "cyan")
@@ -3,9 +3,12 @@ import selectors
 import socket
 import struct
 import traceback
+from bencodepy import encode, decode
 from utils import pretty_print
 from download import FileWriter
+from profiling import span
 import time
+from collections import deque
 
 CHOKE = 0
 UNCHOKE = 1
@@ -17,6 +20,112 @@ REQUEST = 6
 PIECE = 7
 CANCEL = 8
 PORT = 9
+EXTENDED = 20  # BEP 10 extension protocol
+
+EXTENDED_HANDSHAKE = 0
+UT_PEX = 1  # the id we ask peers to use when they send us ut_pex messages
+PEX_INTERVAL = 60  # BEP 11 asks for at most one PEX message per minute
+PEX_MAX_PEERS = 50  # max peers in the added or dropped list of one message
+PEX_WAIT = 1  # how often we check whether the peer told us its ut_pex id yet
+
+RATE_WINDOW = 20  # seconds of history used for the rolling download rate
+MIN_REQUEST_TIMEOUT = 5  # never time out a request faster than this
+MAX_REQUEST_TIMEOUT = 60  # a request older than this is always timed out
+TIMEOUT_CHECK_INTERVAL = 1  # how often the request watchdog wakes up
+SNUB_BACKOFF = 30  # seconds before a snubbed peer gets a probe request
+
+
+# the compact (BEP 23) form of an IPv4 peer, None for anything else
+def compact_peer(ip, port):
+    try:
+        return socket.inet_aton(ip) + struct.pack(">H", port)
+    except OSError:
+        return None
+
+
+# a ut_pex message with what changed since the peers in sent were
+# announced, updates sent; None if nothing changed
+def make_pex_message(addresses, sent):
+    connected = {compact_peer(ip, port) for ip, port in addresses} - {None}
+    added = list(connected - sent)[:PEX_MAX_PEERS]
+    dropped = list(sent - connected)[:PEX_MAX_PEERS]
+    if not added and not dropped:
+        return None
+    sent.update(added)
+    sent.difference_update(dropped)
+    message = {
+        b"added": b"".join(added),
+        b"added.f": bytes(len(added)),
+        b"dropped": b"".join(dropped),
+    }
+    return encode(message)
+
+
+# the (ip, port) of every peer a ut_pex message adds
+def parse_pex_message(payload):
+    added = decode(payload).get(b"added", b"")
+    peers = []
+    for i in range(0, len(added) - 5, 6):
+        ip = socket.inet_ntoa(added[i : i + 4])
+        (port,) = struct.unpack(">H", added[i + 4 : i + 6])
+        peers.append((ip, port))
+    return peers
+
+
+# keeps rolling throughput and round trip time estimates for a single peer
+class PeerStats:
+    def __init__(self):
+        self.samples = deque()  # (arrival time, bytes) of recently received blocks
+        self.srtt = None  # smoothed round trip time
+        self.rttvar = None  # round trip time variance
+        self.request_time = None  # when the outstanding request was sent
+        self.last_block_time = None
+        self.first_block_time = None  # start of the rate window for new peers
+        self.timeouts = 0  # number of requests this peer failed to answer
+
+    def record_request(self):
+        self.request_time = time.time()
+
+    def record_block(self, size):
+        now = time.time()
+        self.samples.append((now, size))
+        self.last_block_time = now
+        if self.first_block_time is None:
+            self.first_block_time = now
+        while self.samples and now - self.samples[0][0] > RATE_WINDOW:
+            self.samples.popleft()
+        if self.request_time is not None:
+            # same smoothing as TCP (RFC 6298)
+            rtt = now - self.request_time
+            if self.srtt is None:
+                self.srtt = rtt
+                self.rttvar = rtt / 2
+            else:
+                self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+                self.srtt = 0.875 * self.srtt + 0.125 * rtt
+            self.request_time = None
+
+    def rate(self):
+        # bytes/second over the last RATE_WINDOW seconds
+        now = time.time()
+        while self.samples and now - self.samples[0][0] > RATE_WINDOW:
+            self.samples.popleft()
+        if not self.samples:
+            return 0
+        # a peer that connected recently hasn't had a full window yet
+        elapsed = max(min(RATE_WINDOW, now - self.first_block_time), 1)
+        return sum(size for _, size in self.samples) / elapsed
+
+    def request_timeout(self):
+        if self.srtt is None:
+            return MAX_REQUEST_TIMEOUT / 2
+        timeout = self.srtt + 4 * self.rttvar
+        return min(max(timeout, MIN_REQUEST_TIMEOUT), MAX_REQUEST_TIMEOUT)
+
+    def timed_out(self):
+        if self.request_time is None:
+            return False
+        return time.time() - self.request_time > self.request_timeout()
 
 
 class PeerConnection:
@@ -32,10 +141,16 @@ class PeerConnection:
         verbose=True,
     ):
         self.waiting = False
+        self.connected = False  # handshake done, safe to send messages
+        self.uploading = False  # we finished and now serve this peer
+        self.snubbed = False  # peer stopped answering our requests
+        self.snub_time = None
+        self.stats = PeerStats()
         self.filewriter = filewriter
         self.torrent = torrent
         self.download_handler = download_handler
         self.pieces = set()
+        self.unchoked = False
         self.pending_piece = None
         self.peer_ip = ip
         self.peer_port = port
@@ -44,6 +159,9 @@ class PeerConnection:
         self.reader = None
         self.writer = None
         self.connection_try = 0  # number of times we tried to connect to this peer
+        self.supports_extensions = False  # peer set the BEP 10 reserved bit
+        self.peer_pex_id = None  # the id the peer wants for ut_pex messages
+        self.pex_sent = set()  # peers we already told this peer about
         self.verbose = verbose  # if you want to allow stacktrace printing
         self.start_time = time.time()  # record the start time of the download
         self.total_pieces = (
@@ -51,26 +169,81 @@ class PeerConnection:
         )  # total number of pieces
 
     async def start(self):
+        watchdog = None
+        pex = None
         try:
             await self.send_handshake()
             await self.validate_handshake()
+            watchdog = asyncio.ensure_future(self.watch_requests())
+            if self.supports_extensions:
+                await self.send_extended_handshake()
+                pex = asyncio.ensure_future(self.exchange_peers())
             await self.listen()
         except:
-            if self.writer:
-                self.writer.close()
             if self.verbose:
                 traceback.print_exc()
             pretty_print("===Lost peer!===", "red")
+        finally:
+            if watchdog:
+                watchdog.cancel()
+            if pex:
+                pex.cancel()
+            self.disconnect()
+
+    # forgets the peer and hands its piece to someone else, whichever way
+    # the connection ended
+    def disconnect(self):
+        if self.writer:
+            self.writer.close()
+        self.connected = False
+        self.waiting = False
+        if self in self.torrent.peer_list:
             self.torrent.peer_list.remove(self)
-            if self.pending_piece:
-                self.download_handler.pending_pieces.append(self.pending_piece)
+        piece = self.pending_piece
+        self.pending_piece = None
+        if piece:
+            self.download_handler.reissue(piece)
+
+    # periodically checks whether the outstanding request has been answered,
+    # and if not, hands the piece back so another peer can finish it
+    async def watch_requests(self):
+        while True:
+            await asyncio.sleep(TIMEOUT_CHECK_INTERVAL)
+            if self.waiting and self.stats.timed_out():
+                self.handle_timeout()
+            elif (
+                self.snubbed
+                and not self.waiting
+                and time.time() - self.snub_time > SNUB_BACKOFF
+            ):
+                # let the peer earn its way back with a probe request
+                self.snubbed = False
+                await self.wake()
+
+    # starts a request chain from outside the message loop, which may have
+    # started one of its own since the call was scheduled
+    async def wake(self):
+        if self.connected and not self.waiting and self.pending_piece is None:
+            await self.send_request()
+
+    def handle_timeout(self):
+        pretty_print(f"[{self.peer_ip}] request timed out, snubbing peer", "red")
+        self.stats.timeouts += 1
+        self.stats.request_time = None
+        self.snubbed = True
+        self.snub_time = time.time()
+        self.waiting = False
+        piece = self.pending_piece
+        self.pending_piece = None
+        if piece:
+            self.download_handler.reissue(piece)
 
     def make_handshake(self):
         return struct.pack(
             ">B19s8s20s20s",
             19,
             "BitTorrent protocol".encode("utf-8"),
-            bytes([0] * 8),
+            bytes([0, 0, 0, 0, 0, 0x10, 0, 0]),  # we support BEP 10 extensions
             self.info_hash,
             self.client_id.encode("utf-8"),
         )
@@ -92,6 +265,12 @@ class PeerConnection:
             raise Exception("The hashes did not match")
         else:
             pretty_print("Handshake validated 🤝", "green")
+        # BEP 27: private torrents only get peers from the tracker, so we
+        # don't speak PEX with them
+        self.supports_extensions = (
+            bool(recv_data[25] & 0x10) and not self.torrent.tracker.private
+        )
+        self.connected = True
 
     def calculate_time_since_download_started(self):
         # time stuff
@@ -124,7 +303,7 @@ class PeerConnection:
 
             (length,) = struct.unpack(">I", data)
             if length == 0:
-                return
+                continue  # keep-alive
             data = await self.reader.readexactly(1)
             (id,) = struct.unpack(">B", data)
 
@@ -142,16 +321,28 @@ class PeerConnection:
             elif id == BITFIELD:
                 pretty_print("Received bitfield", "yellow")
                 await self.handle_bitfield(length)
-            elif id == REQUEST:
-                pass
             elif id == PIECE:
                 await self.handle_piece(length)
-            elif id == CANCEL:
-                pass
+            elif id == EXTENDED:
+                await self.handle_extended(length)
+            elif id == REQUEST and self.uploading:
+                await self.handle_request()
             else:
-                print("Invalid message")
+                if id not in (REQUEST, CANCEL, PORT):
+                    print("Invalid message")
+                # skip the payload so the stream stays in sync
+                await self.reader.readexactly(length - 1)
 
     async def handle_choke(self):
+        self.unchoked = False
+        # a choking peer drops our outstanding request (BEP 3), so hand the
+        # piece back instead of waiting for the request to time out
+        self.waiting = False
+        self.stats.request_time = None
+        piece = self.pending_piece
+        self.pending_piece = None
+        if piece:
+            self.download_handler.reissue(piece)
         self.writer.write(
             struct.pack(
                 ">Ib",
@@ -162,6 +353,8 @@ class PeerConnection:
         await self.writer.drain()
 
     async def handle_unchoke(self):
+        self.unchoked = True
+        self.snubbed = False  # the peer is talking to us again
         if not self.waiting:
             pretty_print("Unchoked!", "green")
             await self.send_request()
@@ -183,66 +376,139 @@ class PeerConnection:
                 if (byte >> (7 - bit)) & 1:  # if bit is set
                     self.download_handler.handle_have(piece_index)
                     self.pieces.add(piece_index)
-                if piece_index >= len(
-                    self.download_handler.needed_pieces
-                ):  # if we have all the pieces
+                if (
+                    piece_index >= self.download_handler.tracker.num_pieces
+                ):  # past the last piece, the rest is padding
                     break
 
+    def send_have(self, piece_index):
+        self.writer.write(struct.pack(">IBI", 5, HAVE, piece_index))
+
+    # the download finished, so stop asking for pieces and let the peer
+    # download from us over the same connection
+    async def start_uploading(self):
+        self.uploading = True
+        self.writer.write(struct.pack(">IB", 1, NOTINTERESTED))
+        self.writer.write(struct.pack(">IB", 1, UNCHOKE))
+        await self.writer.drain()
+
+    async def handle_request(self):
+        index, begin, length = struct.unpack(
+            ">III", await self.reader.readexactly(12)
+        )
+        await self.torrent.seeder.send_piece(self.writer, index, begin, length)
+
+    async def send_extended_message(self, ext_id, payload):
+        self.writer.write(
+            struct.pack(">IBB", len(payload) + 2, EXTENDED, ext_id) + payload
+        )
+        await self.writer.drain()
+
+    async def send_extended_handshake(self):
+        handshake = {
+            b"m": {b"ut_pex": UT_PEX},
+            b"v": b"Quentin Torrentino",
+        }
+        if self.torrent.listening.is_set():
+            # only advertise a port something accepts connections on
+            handshake[b"p"] = self.torrent.seed_port
+        await self.send_extended_message(EXTENDED_HANDSHAKE, encode(handshake))
+
+    async def handle_extended(self, length):
+        data = await self.reader.readexactly(length - 1)
+        ext_id = data[0]
+        if ext_id == EXTENDED_HANDSHAKE:
+            handshake = decode(data[1:])
+            self.peer_pex_id = handshake.get(b"m", {}).get(b"ut_pex") or None
+        elif ext_id == UT_PEX and not self.torrent.tracker.private:
+            for ip, port in parse_pex_message(data[1:]):
+                self.torrent.add_peer(ip, port)
+
+    # periodically tells the peer about the peers we are connected to
+    async def exchange_peers(self):
+        while True:
+            if self.peer_pex_id:
+                await self.send_pex()
+                await asyncio.sleep(PEX_INTERVAL)
+            else:
+                # the first message goes out soon after the peer's handshake
+                await asyncio.sleep(PEX_WAIT)
+
+    async def send_pex(self):
+        addresses = self.torrent.pex_peers()
+        addresses.discard((self.peer_ip, self.peer_port))
+        message = make_pex_message(addresses, self.pex_sent)
+        if message:
+            await self.send_extended_message(self.peer_pex_id, message)
+
     async def handle_piece(self, length):
         piece_index_data = await self.reader.readexactly(4)
         piece_index = struct.unpack(">I", piece_index_data)[0]
         block_offset_data = await self.reader.readexactly(4)
         block_offset = struct.unpack(">I", block_offset_data)[0]
         block_data = await self.reader.readexactly(length - 9)
-        if self.pending_piece:
-            if self.pending_piece.offset == block_offset:
-                self.pending_piece.actual_hash.update(block_data)
-                self.filewriter.write_block(piece_index, block_offset, block_data)
-                self.pending_piece.offset = block_offset + length - 9
+        expected = False
+        with span("handle_piece"):
+            self.stats.record_block(len(block_data))
+            if self.snubbed:
+                # a late answer means the peer is alive again
+                pretty_print(f"[{self.peer_ip}] peer recovered from snub", "green")
+                self.snubbed = False
+            if self.pending_piece:
+                if (
+                    self.pending_piece.index == piece_index
+                    and self.pending_piece.offset == block_offset
+                ):
+                    expected = True
+                    with span("hash"):
+                        self.pending_piece.actual_hash.update(block_data)
+                    self.filewriter.write_block(piece_index, block_offset, block_data)
+                    self.pending_piece.offset = block_offset + length - 9
+                    self.torrent.downloaded += len(block_data)
+        if expected or not self.waiting:
+            # a stale block, e.g. a late answer to a timed out request, must
+            # not start a second request chain next to the one in flight
             await self.send_request()
 
     async def send_request(self):
-        length = self.pending_piece and self.pending_piece.next_block_length()
-        if length is None:
-            if self.pending_piece:
-                # piece finished
-                hash = self.pending_piece.actual_hash.digest()
-                if hash != self.pending_piece.hash:
-                    print("Incorrect hash.")
-                    self.download_handler.pending_pieces.append(self.pending_piece)
-                else:
-                    self.download_handler.finished_pieces.append(self.pending_piece)
-
-                    # time stuff
-                    (
-                        percent_complete,
-                        estimated_remaining_time,
-                    ) = self.calculate_time_since_download_started()
-
-                    pretty_print(
-                        f"[{self.peer_ip}] {percent_complete}% complete, Estimated remaining time: {self.format_time(estimated_remaining_time)}",
-                        "yellow",
-                        end="\r",
-                    )
-
-            self.pending_piece = self.download_handler.next(self.pieces)
-            if self.pending_piece is None:
-                self.waiting = False
-                self.download_handler.check_done()
-                pretty_print("Download complete! Yippee!", "green")
-                self.torrent.complete = True
-                return
-            length = self.pending_piece.next_block_length()
-        self.waiting = True
-        
-        self.writer.write(
-            struct.pack(
-                ">IbIII",
-                13,
-                REQUEST,
-                self.pending_piece.index,
-                self.pending_piece.offset,
-                length,
+        with span("send_request"):
+            length = self.pending_piece and self.pending_piece.next_block_length()
+            if length is None:
+                if self.pending_piece:
+                    # piece finished
+                    if self.download_handler.verify_piece(self.pending_piece):
+                        # time stuff
+                        (
+                            percent_complete,
+                            estimated_remaining_time,
+                        ) = self.calculate_time_since_download_started()
+
+                        pretty_print(
+                            f"[{self.peer_ip}] {percent_complete}% complete, Estimated remaining time: {self.format_time(estimated_remaining_time)}",
+                            "yellow",
+                            end="\r",
+                        )
+
+                self.pending_piece = None
+                if self.snubbed:
+                    # don't hand out work to a peer that isn't answering
+                    self.waiting = False
+                    return
+                self.pending_piece = self.download_handler.next(self.pieces, self)
+                if self.pending_piece is None:
+                    self.waiting = False
+                    return
+                length = self.pending_piece.next_block_length()
+            self.waiting = True
+            self.stats.record_request()
+            self.writer.write(
+                struct.pack(
+                    ">IbIII",
+                    13,
+                    REQUEST,
+                    self.pending_piece.index,
+                    self.pending_piece.offset,
+                    length,
+                )
             )
-        )
-        await self.writer.drain()
+            await self.writer.drain()
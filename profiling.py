@@ -0,0 +1,188 @@
+import asyncio
+import collections
+import cProfile
+import json
+import pstats
+import signal
+import sys
+import threading
+import time
+import traceback
+from utils import pretty_print
+
+SAMPLE_INTERVAL = 0.005  # seconds between stack samples in sampling mode
+TOP_STACKS = 20  # stacks written to a sampling capture
+
+
+# records how long each stage takes, as one JSON object per line, so a slow
+# run can be broken down afterwards; costs next to nothing while disabled
+class SpanRecorder:
+    def __init__(self):
+        self.file = None
+
+    def enable(self, path):
+        self.file = open(path, "a")
+        pretty_print(f"Writing timing spans to {path}", "cyan")
+
+    def span(self, name):
+        if self.file is None:
+            return NULL_SPAN
+        return Span(self, name)
+
+    def record(self, name, start, duration):
+        self.file.write(
+            json.dumps({"name": name, "start": start, "duration": duration}) + "\n"
+        )
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
+class Span:
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+
+    def __enter__(self):
+        self.wall_start = time.time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        duration = time.perf_counter() - self.start
+        if self.recorder.file:
+            self.recorder.record(self.name, self.wall_start, duration)
+        return False
+
+
+class NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_SPAN = NullSpan()
+spans = SpanRecorder()
+span = spans.span
+
+
+# a thread that notices when the event loop hasn't run for too long and
+# dumps the stack of whatever is holding it
+class LoopLagWatchdog:
+    def __init__(self, threshold, log_path=None):
+        self.threshold = threshold  # seconds the loop may be blocked
+        self.log_path = log_path
+        self.last_beat = time.monotonic()
+        self.loop_thread_id = None
+        self.stopped = threading.Event()
+
+    async def start(self):
+        self.loop_thread_id = threading.get_ident()
+        threading.Thread(target=self.watch, daemon=True).start()
+        pretty_print(
+            f"Loop lag watchdog on, threshold {self.threshold * 1000:.0f}ms", "cyan"
+        )
+        try:
+            while True:
+                self.last_beat = time.monotonic()
+                await asyncio.sleep(self.threshold / 4)
+        finally:
+            self.stopped.set()
+
+    def watch(self):
+        reported = None  # the beat we already dumped a stack for
+        while not self.stopped.wait(self.threshold / 4):
+            beat = self.last_beat
+            lag = time.monotonic() - beat
+            if lag > self.threshold and beat != reported:
+                reported = beat
+                self.report(lag)
+
+    def report(self, lag):
+        frame = sys._current_frames().get(self.loop_thread_id)
+        stack = "".join(traceback.format_stack(frame)) if frame else ""
+        message = f"Event loop blocked for {lag * 1000:.0f}ms in:\n{stack}"
+        pretty_print(message, "red")
+        if self.log_path:
+            with open(self.log_path, "a") as f:
+                f.write(f"{time.strftime('%Y-%m-%d %H:%M:%S')} {message}\n")
+
+
+# on-demand captures, either with cProfile or by sampling the loop
+# thread's stack, which is cheap enough to leave running under load
+class Profiler:
+    def __init__(self, mode="cprofile", output_prefix="profile"):
+        self.mode = mode
+        self.output_prefix = output_prefix
+        self.profile = None
+        self.samples = None
+        self.sampling = None
+        self.sampler = None
+        self.loop_thread_id = None
+
+    def running(self):
+        return self.profile is not None or self.samples is not None
+
+    def start(self):
+        if self.running():
+            return
+        pretty_print(f"Starting {self.mode} capture", "cyan")
+        if self.mode == "sample":
+            self.loop_thread_id = threading.get_ident()
+            self.samples = collections.Counter()
+            self.sampling = threading.Event()
+            self.sampler = threading.Thread(target=self.sample, daemon=True)
+            self.sampler.start()
+        else:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+
+    def stop(self):
+        if not self.running():
+            return None
+        path = f"{self.output_prefix}-{time.strftime('%Y%m%d-%H%M%S')}"
+        if self.mode == "sample":
+            self.sampling.set()
+            # the sampler may be adding to the counter, let it finish first
+            self.sampler.join()
+            self.sampler = None
+            path += ".txt"
+            with open(path, "w") as f:
+                total = sum(self.samples.values())
+                for stack, count in self.samples.most_common(TOP_STACKS):
+                    f.write(f"{count} samples ({count * 100 / total:.1f}%)\n")
+                    f.write("".join(stack) + "\n")
+            self.samples = None
+        else:
+            self.profile.disable()
+            path += ".prof"
+            pstats.Stats(self.profile).dump_stats(path)
+            self.profile = None
+        pretty_print(f"Wrote {self.mode} capture to {path}", "cyan")
+        return path
+
+    def toggle(self):
+        if self.running():
+            self.stop()
+        else:
+            self.start()
+
+    def sample(self):
+        samples = self.samples
+        while not self.sampling.wait(SAMPLE_INTERVAL):
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame:
+                samples[tuple(traceback.format_stack(frame))] += 1
+
+    # e.g. kill -USR1 <pid> to start a capture and again to write it out
+    def install_signal_handler(self, sig=signal.SIGUSR1):
+        asyncio.get_running_loop().add_signal_handler(sig, self.toggle)
+
+    async def capture_for(self, seconds):
+        self.start()
+        await asyncio.sleep(seconds)
+        self.stop()
@@ -1,6 +1,17 @@
 import asyncio
+import random
 import struct
+from bencodepy import encode, decode, DecodingError
 from utils import pretty_print
+from cache import PieceCache, DEFAULT_CACHE_SIZE
+from peer import (
+    EXTENDED_HANDSHAKE,
+    UT_PEX,
+    PEX_INTERVAL,
+    PEX_WAIT,
+    make_pex_message,
+    parse_pex_message,
+)
 
 CHOKE = 0
 UNCHOKE = 1
@@ -12,10 +23,40 @@ REQUEST = 6
 PIECE = 7
 CANCEL = 8
 PORT = 9
+EXTENDED = 20  # BEP 10 extension protocol
+
+# in super-seeding mode, a piece a peer finished but nobody else announced
+# is given up on after this many seconds and the peer is offered another
+PROPAGATION_TIMEOUT = 30
+
+
+# what the seeder knows about one connected peer
+class SeedPeer:
+    def __init__(self, addr, writer):
+        self.addr = addr
+        self.writer = writer
+        self.has = set()  # pieces the peer announced with HAVE or BITFIELD
+        self.offered = None  # piece we revealed to the peer in super-seeding
+        self.timer = None  # fallback for an offered piece that never spreads
+        self.supports_extensions = False  # peer set the BEP 10 reserved bit
+        self.pex_id = None  # the id the peer wants for ut_pex messages
+        self.pex_sent = set()  # peers we already told this peer about
+        self.pex = None  # task sending this peer PEX messages
+        self.listen_port = None  # from the p of the peer's extended handshake
 
 
 class Seeder:
-    def __init__(self, host, port, peer_id, info_hash, filewriter, torrent):
+    def __init__(
+        self,
+        host,
+        port,
+        peer_id,
+        info_hash,
+        filewriter,
+        torrent,
+        cache_size=DEFAULT_CACHE_SIZE,
+        super_seed=False,
+    ):
         self.host = host
         self.port = port
         self.peer_id = peer_id
@@ -23,17 +64,33 @@ class Seeder:
         self.filewriter = filewriter
         self.torrent = torrent
         self.server = None
+        self.cache = PieceCache(filewriter, cache_size)
+        self.super_seed = super_seed
+        # BEP 27: private torrents only get peers from the tracker
+        self.extensions = not torrent.tracker.private
+        self.num_pieces = len(filewriter.pieces)
+        self.peers = {}  # writer -> SeedPeer
+        self.offers = [0] * self.num_pieces  # times each piece was revealed
+        self.seen = [0] * self.num_pieces  # peers that announced each piece
+        self.uploaded = 0  # bytes this seeder sent
+        self.full_copies = 0  # peers that announced every piece
 
     async def start(self):
+        if self.server is None:
+            await self.open()
+
+        async with self.server:
+            await self.server.serve_forever()
+
+    # binds the port, connections are accepted from here on
+    async def open(self):
         self.server = await asyncio.start_server(
             self.handle_peer_connection, self.host, self.port
         )
 
         addr = self.server.sockets[0].getsockname()
         print(f"Seeding on {addr}")
-
-        async with self.server:
-            await self.server.serve_forever()
+        self.torrent.listening.set()
 
     async def send_bitfield(self, writer):
         bitfield = self.filewriter.get_bitfield()
@@ -52,38 +109,225 @@ class Seeder:
             print(f"Invalid handshake from {addr}")
             writer.close()
             return
+        if handshake[48:68] == self.peer_id.encode("utf-8"):
+            # the tracker or PEX gave us our own address
+            writer.close()
+            return
         else:
             pretty_print(f"Valid handshake from {addr}", "green")
 
-        # send handshake
-        writer.write(handshake)
+        # send handshake, with the extension bit if we speak PEX
+        reserved = bytes([0, 0, 0, 0, 0, 0x10 if self.extensions else 0, 0, 0])
+        writer.write(
+            handshake[:20] + reserved + self.info_hash + self.peer_id.encode("utf-8")
+        )
+
+        peer = SeedPeer(addr, writer)
+        peer.supports_extensions = self.extensions and bool(handshake[25] & 0x10)
+        self.peers[writer] = peer
+        try:
+            if self.super_seed:
+                # no bitfield, we reveal one piece at a time instead
+                self.offer_piece(peer)
+            else:
+                # send bitfield
+                await self.send_bitfield(writer)
+
+            # send UNCHOKE
+            writer.write(struct.pack(">IB", 1, UNCHOKE))
 
-        # send bitfield
-        await self.send_bitfield(writer)
+            if peer.supports_extensions:
+                self.send_extended_handshake(peer)
+                peer.pex = asyncio.ensure_future(self.exchange_peers(peer))
 
-        # send UNCHOKE
-        writer.write(struct.pack(">IB", 1, UNCHOKE))
+            # Handle incoming requests
+            await self.listen(reader, writer, peer)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass  # peer went away mid message
+        except DecodingError:
+            print(f"Invalid extended message from {addr}")
+        finally:
+            print(f"Connection closed by {addr}")
+            pretty_print(f"Piece cache: {self.cache.stats()}", "cyan")
+            pretty_print(f"Upload: {self.upload_stats()}", "cyan")
+            self.remove_peer(peer)
+            writer.close()
 
-        # Handle incoming requests
+    async def listen(self, reader, writer, peer):
         while not reader.at_eof():
-            message_length_data = await reader.read(4)
+            message_length_data = await reader.readexactly(4)
             message_length = struct.unpack(">I", message_length_data)[0]
             if message_length == 0:
                 continue  # keep-alive message
 
-            message_id_data = await reader.read(1)
+            message_id_data = await reader.readexactly(1)
             message_id = struct.unpack(">B", message_id_data)[0]
 
             if message_id == REQUEST:
                 # Peer requested a piece
-                index, begin, length = struct.unpack(">III", await reader.read(12))
+                index, begin, length = struct.unpack(
+                    ">III", await reader.readexactly(12)
+                )
                 await self.send_piece(writer, index, begin, length)
 
+            elif message_id == HAVE:
+                (index,) = struct.unpack(">I", await reader.readexactly(4))
+                self.handle_have(peer, index)
+
+            elif message_id == BITFIELD:
+                bitfield = await reader.readexactly(message_length - 1)
+                if len(bitfield) < -(-self.num_pieces // 8):  # ceil division
+                    print(f"Bitfield too short from {peer.addr}, dropping peer")
+                    return
+                for index in range(self.num_pieces):
+                    if bitfield[index // 8] >> (7 - index % 8) & 1:
+                        self.handle_have(peer, index)
+
+            elif message_id == EXTENDED:
+                self.handle_extended(peer, await reader.readexactly(message_length - 1))
+
             else:
-                print(f"Unexpected message id {message_id} from {addr}")
+                if message_id not in (
+                    CHOKE,
+                    UNCHOKE,
+                    INTERESTED,
+                    NOTINTERESTED,
+                ):
+                    print(f"Unexpected message id {message_id} from {peer.addr}")
+                # skip the payload so the stream stays in sync
+                await reader.readexactly(message_length - 1)
+
+    def remove_peer(self, peer):
+        if peer.timer:
+            peer.timer.cancel()
+            peer.timer = None
+        if peer.pex:
+            peer.pex.cancel()
+        if peer.offered is not None and peer.offered not in peer.has:
+            # the piece never got out, so it shouldn't count as offered
+            self.offers[peer.offered] -= 1
+        self.peers.pop(peer.writer, None)
+
+    def send_extended_message(self, peer, ext_id, payload):
+        peer.writer.write(
+            struct.pack(">IBB", len(payload) + 2, EXTENDED, ext_id) + payload
+        )
+
+    def send_extended_handshake(self, peer):
+        handshake = {
+            b"m": {b"ut_pex": UT_PEX},
+            b"p": self.port,
+            b"v": b"Quentin Torrentino",
+        }
+        self.send_extended_message(peer, EXTENDED_HANDSHAKE, encode(handshake))
+
+    def handle_extended(self, peer, data):
+        if not peer.supports_extensions:
+            return
+        ext_id = data[0]
+        if ext_id == EXTENDED_HANDSHAKE:
+            handshake = decode(data[1:])
+            peer.pex_id = handshake.get(b"m", {}).get(b"ut_pex") or None
+            port = handshake.get(b"p")
+            if isinstance(port, int) and 0 < port < 65536:
+                # the connection comes from an ephemeral port, this is
+                # where the peer accepts connections
+                peer.listen_port = port
+        elif ext_id == UT_PEX:
+            for ip, port in parse_pex_message(data[1:]):
+                self.torrent.add_peer(ip, port)
+
+    # periodically tells the peer about the other peers in the swarm
+    async def exchange_peers(self, peer):
+        while True:
+            if not peer.pex_id:
+                await asyncio.sleep(PEX_WAIT)  # no extended handshake yet
+                continue
+            addresses = self.torrent.pex_peers()
+            addresses.discard((peer.addr[0], peer.listen_port))
+            message = make_pex_message(addresses, peer.pex_sent)
+            if message:
+                self.send_extended_message(peer, peer.pex_id, message)
+                await peer.writer.drain()
+            await asyncio.sleep(PEX_INTERVAL)
+
+    # where the peers that told us their port accept connections
+    def listen_addresses(self):
+        return {
+            (peer.addr[0], peer.listen_port)
+            for peer in self.peers.values()
+            if peer.listen_port
+        }
+
+    # tells the connected peers about a piece we just verified, so they
+    # can download it from us while we download the rest
+    def send_have(self, index):
+        if self.super_seed:
+            return  # pieces are revealed one at a time instead
+        for peer in self.peers.values():
+            if index not in peer.has:
+                peer.writer.write(struct.pack(">IBI", 5, HAVE, index))
 
-        print(f"Connection closed by {addr}")
-        writer.close()
+    def handle_have(self, peer, index):
+        if index >= self.num_pieces or index in peer.has:
+            return
+        peer.has.add(index)
+        self.seen[index] += 1
+        if len(peer.has) == self.num_pieces:
+            self.full_copies += 1
+        if not self.super_seed:
+            return
+        for other in self.peers.values():
+            if other is not peer and other.offered == index:
+                # the piece spread from the peer we gave it to, so that
+                # peer has earned a new one
+                self.offer_piece(other)
+        if peer.offered == index and (self.seen[index] > 1 or len(self.peers) == 1):
+            # someone else already had it, or there is no one to spread it to
+            self.offer_piece(peer)
+        elif peer.offered == index:
+            # the peer finished its piece, give it some time to spread
+            peer.timer = asyncio.get_running_loop().call_later(
+                PROPAGATION_TIMEOUT, self.propagation_timeout, peer, index
+            )
+
+    def propagation_timeout(self, peer, index):
+        peer.timer = None
+        if peer.offered == index and peer.writer in self.peers:
+            self.offer_piece(peer)
+
+    # BEP 16: reveal the piece the fewest peers have seen or been offered
+    def offer_piece(self, peer):
+        if peer.timer:
+            peer.timer.cancel()
+            peer.timer = None
+        candidates = [i for i in range(self.num_pieces) if i not in peer.has]
+        if not candidates:
+            peer.offered = None
+            return
+        fewest = min(self.seen[i] + self.offers[i] for i in candidates)
+        index = random.choice(
+            [i for i in candidates if self.seen[i] + self.offers[i] == fewest]
+        )
+        peer.offered = index
+        self.offers[index] += 1
+        peer.writer.write(struct.pack(">IBI", 5, HAVE, index))
+
+    # origin bytes sent for every full copy that reached the swarm, the
+    # closer to 1.0 the less the origin's uplink was spent on duplicates
+    def upload_ratio(self):
+        if not self.full_copies:
+            return None
+        return self.uploaded / (self.full_copies * self.filewriter.total_size)
+
+    def upload_stats(self):
+        ratio = self.upload_ratio()
+        if ratio is None:
+            return f"{self.uploaded} bytes sent, no full copy yet"
+        return (
+            f"{self.uploaded} bytes sent, {self.full_copies} full copies, "
+            f"{ratio:.2f} origin bytes per copied byte"
+        )
 
     def is_valid_handshake(self, handshake):
         recv_hash = handshake[28:48]
@@ -95,14 +339,17 @@ class Seeder:
                 f"Sending piece {index} (offset {begin}, length {length})", "green"
             )
 
-            # Read the requested piece from the file
-            piece_data = self.filewriter.read_piece(index, begin, length)
-            
+            # Read the requested block, from memory if the piece is cached
+            piece_data = self.cache.read(index, begin, length)
+            if piece_data is None:
+                print(f"Dropping invalid request for piece {index} ({begin}+{length})")
+                return
 
             # Send piece message: length prefix (4 bytes) + message ID (1 byte) + piece index (4 bytes) + block offset (4 bytes) + block data
             writer.write(struct.pack(">IbII", 9 + len(piece_data), PIECE, index, begin))
             writer.write(piece_data)
             self.torrent.uploaded += len(piece_data)
+            self.uploaded += len(piece_data)
 
             await writer.drain()
         except Exception as e:
@@ -9,7 +9,19 @@ import asyncio
 from download import DownloadHandler, FileWriter
 import traceback
 from utils import pretty_print
+from profiling import span
 from seeder import Seeder
+from lsd import LocalServiceDiscovery
+from webseed import WebSeed, HTTPConnectionPool
+
+# torrent states, in the order a torrent normally goes through them
+CHECKING = "checking"
+DOWNLOADING = "downloading"
+SEEDING = "seeding"
+STOPPED = "stopped"
+
+MIN_ANNOUNCE_INTERVAL = 30  # don't hammer trackers that send no interval
+ANNOUNCE_TIMEOUT = 30  # seconds before we give up on a tracker that won't answer
 
 
 class Torrent:
@@ -17,43 +29,68 @@ class Torrent:
         self,
         path,
         verbose=True,
-        port=6881,
         compact=0,
         max_connections=50,
         preferred_file_name=None,
+        seed_port=6886,
+        local_discovery=False,
+        metadata_cache_dir=None,
+        web_seed_connections=2,
+        seed_existing=False,
+        super_seed=False,
     ):
         self.peer_id = "-WC0001-" + "".join(
             [str(random.randint(0, 9)) for _ in range(12)]
         )
-        self.port = port  # what port is the client reading from
         self.compact = compact  # do we accept compact responses
         self.uploaded = 0  # bytes uploaded
         self.downloaded = 0  # bytes downloaded
-        self.event = "started"  # auto-set to started and will be updated over time
         self.interval = 0
+        self.state = CHECKING
         self.complete = False  # used for seeding
+        self.completed_event = asyncio.Event()  # set as soon as the last piece verifies
+        self.listening = asyncio.Event()  # set once the seeder accepts connections
+        self.seeder = None
+        self.seed_existing = seed_existing  # the file is already complete
+        self.super_seed = super_seed  # BEP 16, for the initial seed of a payload
         self.peer_list = []  # empty to start
+        self.connecting = False  # new peers are started as soon as they are found
+        self.seed_port = seed_port  # port the seeder accepts connections on
         self.max_connections = max_connections
         self.verbose = verbose  # if you want to allow stacktrace printing
         # prevents race conditions when updating peer list
         self.peer_list_lock = asyncio.Lock()
-        self.tracker = Tracker(path, self)
-        self.filewriter = FileWriter(preferred_file_name or self.tracker.name, self)
+        self.tracker = Tracker(path, self, metadata_cache_dir)
+        self.filewriter = FileWriter(
+            preferred_file_name or self.tracker.name, self, seed_existing
+        )
         self.download_handler = DownloadHandler(self.tracker, self)
+        # finds peers for the same torrent on the local network (BEP 14)
+        self.lsd = LocalServiceDiscovery(self) if local_discovery else None
+        # BEP 19 web seeds, with a few workers per url sharing keep-alive connections
+        self.http_pool = HTTPConnectionPool()
+        self.web_seeds = [
+            WebSeed(url, self, self.http_pool, self.verbose)
+            for url in self.tracker.url_list
+            for _ in range(web_seed_connections)
+        ]
         self.left = self.tracker.length  # bytes left before fiel is complete
-        self.ping_tracker()  # interval and peer list are updated
+        if seed_existing:
+            self.left = 0
 
-    def make_HTTP_request(self):
+    def make_HTTP_request(self, event=None):
         params = {
             "info_hash": urllib.parse.quote(self.tracker.info_hash),
             "peer_id": self.peer_id,
-            "port": self.port,
+            "port": self.seed_port,  # where other peers can connect to us
             "uploaded": self.uploaded,
             "downloaded": self.downloaded,
             "left": self.left,
             "compact": self.compact,
-            "event": self.event,
         }
+        if event:
+            # regular re-announces leave the event out
+            params["event"] = event
         host = self.tracker.announce.split("/")[2]
         payload_start = self.tracker.announce.replace("http://", "").replace(
             self.tracker.announce.split("/")[2], ""
@@ -71,128 +108,187 @@ class Torrent:
 
         return request
 
-    def ping_tracker(self):
+    async def ping_tracker(self, event=None):
+        with span("ping_tracker"):
+            await asyncio.wait_for(self.request_tracker(event), ANNOUNCE_TIMEOUT)
+
+    async def request_tracker(self, event):
         tracker_data = self.tracker
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-            sock.connect((tracker_data.announce_host, tracker_data.announce_port))
-            request = self.make_HTTP_request()
-            sock.sendall(request.encode("utf-8"))
-            response = b""
-            while True:
-                chunk = sock.recv(4096)
-                if not chunk:
-                    break
-                response += chunk
-            _, payload = response.split(b"\r\n\r\n", 1)
-            tracker_data = decode(payload)
-            self.interval = tracker_data.get(b"interval", 0)
-            if type(tracker_data.get(b"peers")) == bytes:
-                peers_raw = tracker_data.get(b"peers", b"")
-                for i in range(
-                    0, len(peers_raw), 6
-                ):  # iterate through the values in peers_raw
-                    try:
-                        ip = socket.inet_ntoa(peers_raw[i : i + 4])
-                        port = struct.unpack(">H", peers_raw[i + 4 : i + 6])[0]
-                        peer = PeerConnection(  # create a new connection for each peer
-                            self.download_handler,
-                            ip,
-                            port,
-                            self.peer_id,
-                            self.tracker.info_hash,
-                            self.filewriter,
-                            self,
-                            self.verbose,  # flag to allow stacktrace printing
-                        )
-                        # add the peers to the list
-                        self.peer_list.append(peer)
-                    except:
-                        if self.verbose:
-                            traceback.print_exc()
-            else:
-                peers_list = tracker_data.get(b"peers", [])
-                for peer_dict in peers_list:
-                    ip = peer_dict[b"ip"]
-                    port = peer_dict[b"port"]
-                    peer = PeerConnection(  # create a new connection for each peer
-                        self.download_handler,
-                        ip,
-                        port,
-                        self.peer_id,
-                        self.tracker.info_hash,
-                        self.filewriter,
-                        self,
-                        self.verbose,  # flag to allow stacktrace printing
-                    )
-                    self.peer_list.append(peer)
+        reader, writer = await asyncio.open_connection(
+            tracker_data.announce_host, tracker_data.announce_port
+        )
+        try:
+            request = self.make_HTTP_request(event)
+            writer.write(request.encode("utf-8"))
+            await writer.drain()
+            response = await reader.read()  # the tracker closes the connection
+        finally:
+            writer.close()
+        _, payload = response.split(b"\r\n\r\n", 1)
+        tracker_data = decode(payload)
+        self.interval = tracker_data.get(b"interval", 0)
+        if type(tracker_data.get(b"peers")) == bytes:
+            peers_raw = tracker_data.get(b"peers", b"")
+            for i in range(
+                0, len(peers_raw), 6
+            ):  # iterate through the values in peers_raw
+                try:
+                    ip = socket.inet_ntoa(peers_raw[i : i + 4])
+                    port = struct.unpack(">H", peers_raw[i + 4 : i + 6])[0]
+                    self.add_peer(ip, port)
+                except:
+                    if self.verbose:
+                        traceback.print_exc()
+        else:
+            peers_list = tracker_data.get(b"peers", [])
+            for peer_dict in peers_list:
+                ip = peer_dict[b"ip"].decode("utf-8")
+                port = peer_dict[b"port"]
+                self.add_peer(ip, port)
+
+    # announces in the background, a slow tracker never holds up peers
+    async def announce(self, event=None):
+        try:
+            await self.ping_tracker(event)
+        except Exception:
+            pretty_print(f"Announce ({event or 'interval'}) failed", "red")
+            if self.verbose:
+                traceback.print_exc()
+
+    # single entry point for peers from the tracker, PEX and local discovery
+    def add_peer(self, ip, port):
+        if self.state == STOPPED or len(self.peer_list) >= self.max_connections:
+            return None
+        for peer in self.peer_list:
+            if peer.peer_ip == ip and peer.peer_port == port:
+                return None  # already known
+        peer = PeerConnection(  # create a new connection for each peer
+            self.download_handler,
+            ip,
+            port,
+            self.peer_id,
+            self.tracker.info_hash,
+            self.filewriter,
+            self,
+            self.verbose,  # flag to allow stacktrace printing
+        )
+        self.peer_list.append(peer)
+        if self.connecting:
+            # the download is already running, so connect right away
+            asyncio.ensure_future(peer.start())
+        return peer
+
+    # the peers we can tell others about in PEX: our outgoing connections,
+    # and incoming ones that told us the port they accept connections on
+    def pex_peers(self):
+        peers = {
+            (peer.peer_ip, peer.peer_port) for peer in self.peer_list if peer.connected
+        }
+        if self.seeder:
+            peers.update(self.seeder.listen_addresses())
+        return peers
 
     async def initiate_download(self):
         async with self.peer_list_lock:
-            await asyncio.gather(*(peer.start() for peer in self.peer_list))
+            self.connecting = True
+            await asyncio.gather(
+                *(peer.start() for peer in self.peer_list),
+                *(web_seed.start() for web_seed in self.web_seeds),
+            )
 
     async def refresh_peers(self):
-        while True:
+        while self.state != STOPPED:
+            await asyncio.sleep(max(self.interval, MIN_ANNOUNCE_INTERVAL))
             pretty_print("refresing peers", "cyan")
-            async with self.peer_list_lock:
-                # self.peer_list = []
-                self.ping_tracker()
-            await asyncio.sleep(self.interval)
-
-    
-    
-    def ping_tracker_complete(self):
-        self.event = "completed"
-        self.downloaded = self.tracker.length
+            await self.announce()
+
+    def send_have(self, piece_index):
+        # tell everyone we're connected to about a newly verified piece
+        for peer in self.peer_list:
+            if peer.connected:
+                peer.send_have(piece_index)
+        if self.seeder:
+            self.seeder.send_have(piece_index)
+
+    def make_seeder(self):
+        self.seeder = Seeder(
+            "0.0.0.0",
+            self.seed_port,
+            self.peer_id,
+            self.tracker.info_hash,
+            self.filewriter,
+            self,
+            super_seed=self.super_seed,
+        )
+
+    # called from the verify path as soon as the last piece checks out
+    def on_complete(self):
+        if self.state != DOWNLOADING:
+            return
+        pretty_print("Download complete! Yippee!", "green")
+        self.state = SEEDING
+        self.complete = True
         self.left = 0
-        tracker_data = self.tracker
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-            sock.connect((tracker_data.announce_host, tracker_data.announce_port))
-            request = self.make_HTTP_request()
-            sock.sendall(request.encode("utf-8"))
-            response = b""
-            while True:
-                chunk = sock.recv(4096)
-                if not chunk:
-                    break
-                response += chunk
-            _, payload = response.split(b"\r\n\r\n", 1)
-            tracker_data = decode(payload)
-            self.interval = tracker_data.get(b"interval", 0)
-            self.event = "started"  # reset the event back to "started"
-        
-        
-        
+        # the peers we downloaded from can now download from us
+        for peer in self.peer_list:
+            if peer.connected:
+                asyncio.ensure_future(peer.start_uploading())
+        asyncio.ensure_future(self.announce("completed"))
+        self.completed_event.set()
+
     # ip addr of the seeder is 0.0.0.0
-    # port is 6886
-    # put these as cli args
+    # port is self.seed_port (6886 by default)
     async def seed(self):
-        self.ping_tracker_complete()
         pretty_print("starting seeding", "cyan")
-        server = Seeder('0.0.0.0', 6886, self.peer_id,  self.tracker.info_hash, self.filewriter, self)
-        await server.start()
-
-    # the program only starts seeding five seconds
-    # after the download is complete
-    async def start_seeding(self):
-        started = False
-        while True:
-            await asyncio.sleep(5)
-            if self.complete == True and started == False:
-                started = True
-                await asyncio.gather(
-                    self.seed(),
-                )
+        await self.seeder.start()
+
+    # the seeder listens from the start, so other peers can download the
+    # pieces we verified while we download the rest; returns whether it can
+    async def open_seeder(self):
+        try:
+            await self.seeder.open()
+            return True
+        except OSError as e:
+            pretty_print(f"Can't accept connections on {self.seed_port}: {e}", "red")
+            return False
 
     async def start_connections(self, preferred_peer_list=None):
+        self.make_seeder()
+        if self.seed_existing:
+            # nothing to download, leechers come to the seeder
+            self.state = SEEDING
+            self.complete = True
+            self.completed_event.set()
+        else:
+            self.state = DOWNLOADING
         self.peer_list = preferred_peer_list or self.peer_list
         # append tasks here to run them concurrently
-        await asyncio.gather(
-            self.initiate_download(),  # task 1
-            self.start_seeding()
-        )
+        tasks = []
+        # bound before we connect out, so our extended handshakes carry p
+        if await self.open_seeder():
+            tasks.append(self.seed())
+        if not self.seed_existing:
+            tasks.append(self.initiate_download())
+        tasks += [
+            # peers from the tracker are started by add_peer as they arrive,
+            # so a slow tracker doesn't hold up web seeds, LSD or known peers
+            self.announce("started"),
+            self.refresh_peers(),
+        ]
+        if self.lsd:
+            tasks.append(self.lsd.start())
+        await asyncio.gather(*tasks)
 
-        await asyncio.gather(
-            # self.initiate_download(),  # task 1
-            self.refresh_peers(),  # task 2
-            # self.start_seeding()
-        )
+    async def stop(self):
+        if self.state == STOPPED:
+            return
+        self.state = STOPPED
+        self.completed_event.set()  # wakes anything waiting for the download
+        if self.seeder and self.seeder.server:
+            self.seeder.server.close()
+        self.listening.clear()
+        for peer in self.peer_list:
+            if peer.writer:
+                peer.writer.close()
+        self.http_pool.close()
+        await self.announce("stopped")
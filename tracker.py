@@ -1,20 +1,46 @@
-from peer import PeerConnection
-from bencodepy import encode, decode
-import struct
 import hashlib
-import urllib.parse
-import socket
+import json
 import math
+import os
+from lazy_bencode import LazyDict
+
+
+# torrent metadata that is derived from the .torrent file and worth caching
+CACHED_FIELDS = [
+    "announce",
+    "announce_list",
+    "creation_date",
+    "comment",
+    "created_by",
+    "encoding",
+    "piece_length",
+    "private",
+    "name",
+    "length",
+    "mdf5sum",
+    "url_list",
+]
 
 
 class Tracker:
-    def __init__(self, path, torrent):
+    def __init__(self, path, torrent, cache_dir=None):
         with open(path, "rb") as f:
             torrent_data = f.read()
-        torrent = decode(torrent_data)
-        self.announce = torrent.get(b"announce", b"").decode("utf-8")
+        self.data = memoryview(torrent_data)
+        self.cache_path = None
+        if cache_dir:
+            self.cache_path = os.path.join(cache_dir, self.cache_key(path) + ".json")
+        if not self.load_cache():
+            self.parse()
+            self.save_cache()
         self.announce_host, self.announce_port = self.announce.split("/")[2].split(":")
         self.announce_port = int(self.announce_port)
+        self.num_pieces = math.ceil(self.length / self.piece_length)
+        self.blocks_per_piece = math.ceil(self.piece_length / 2**14)
+
+    def parse(self):
+        torrent = LazyDict(self.data)
+        self.announce = torrent.get(b"announce", b"").decode("utf-8")
         self.announce_list = torrent.get(b"announce-list", [])
         self.announce_list = [
             [url.decode("utf-8") for url in group] for group in self.announce_list
@@ -23,17 +49,55 @@ class Tracker:
         self.comment = torrent.get(b"comment", b"").decode("utf-8")
         self.created_by = torrent.get(b"created by", b"").decode("utf-8")
         self.encoding = torrent.get(b"encoding", b"").decode("utf-8")
-        self.info = torrent[b"info"]
-        self.info_hash = hashlib.sha1(encode(self.info)).digest()
-        self.piece_length = self.info[b"piece length"]
-        self.pieces = self.info[b"pieces"]
-        self.private = self.info.get(b"private", 0)
-        self.name = self.info[b"name"].decode("utf-8")
-        self.length = self.info[b"length"]
-        self.mdf5sum = self.info.get(b"md5sum", b"").decode("utf-8")
-        self.num_pieces = math.ceil(self.length / self.piece_length)
-        self.blocks_per_piece = math.ceil(self.piece_length / 2**14)
-        self.torrent = torrent
+        # BEP 19 web seeds, either a single url or a list of them
+        self.url_list = torrent.get(b"url-list", [])
+        if isinstance(self.url_list, bytes):
+            self.url_list = [self.url_list]
+        self.url_list = [url.decode("utf-8") for url in self.url_list if url]
+        info = torrent[b"info"]
+        # hash the info dict exactly as it appears in the file
+        self.info_hash = hashlib.sha1(torrent.raw(b"info")).digest()
+        self.piece_length = info[b"piece length"]
+        # zero-copy view into the file data, 20 bytes per piece
+        self.pieces_span = info.span(b"pieces")
+        self.pieces = self.data[self.pieces_span[0] : self.pieces_span[1]]
+        self.private = info.get(b"private", 0)
+        self.name = info[b"name"].decode("utf-8")
+        self.length = info[b"length"]
+        self.mdf5sum = info.get(b"md5sum", b"").decode("utf-8")
+
+    # the cache is keyed on the file's identity rather than its contents,
+    # hashing the contents would cost as much as the info hash we want to skip
+    def cache_key(self, path):
+        stat = os.stat(path)
+        key = f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def load_cache(self):
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return False
+        try:
+            with open(self.cache_path) as f:
+                cached = json.load(f)
+            for field in CACHED_FIELDS:
+                setattr(self, field, cached[field])
+            self.info_hash = bytes.fromhex(cached["info_hash"])
+            self.pieces_span = tuple(cached["pieces"])
+            self.pieces = self.data[self.pieces_span[0] : self.pieces_span[1]]
+        except (ValueError, KeyError, TypeError):
+            return False  # corrupt or from an older version, parse again
+        return True
+
+    def save_cache(self):
+        if not self.cache_path:
+            return
+        cached = {field: getattr(self, field) for field in CACHED_FIELDS}
+        cached["info_hash"] = self.info_hash.hex()
+        # where the pieces string sits in the file, so a reload can slice it
+        cached["pieces"] = list(self.pieces_span)
+        os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+        with open(self.cache_path, "w") as f:
+            json.dump(cached, f)
 
     def __str__(self):
         output = (
@@ -49,6 +113,7 @@ class Tracker:
             f"Name: {self.name}\n"
             f"Length: {self.length}\n"
             f"MD5Sum: {self.mdf5sum}\n"
+            f"Web Seeds: {self.url_list}\n"
         )
         return output
 
@@ -0,0 +1,220 @@
+import asyncio
+import traceback
+import urllib.parse
+from peer import PeerStats
+from utils import pretty_print
+from profiling import span
+
+WEB_SEED_IDLE_INTERVAL = 1  # how often an idle worker checks for new work
+WEB_SEED_MAX_FAILURES = 5  # consecutive failures before a worker gives up
+WEB_SEED_RETRY_DELAY = 2  # seconds, doubled after every failed request
+WEB_SEED_MAX_REDIRECTS = 3  # Location hops followed for a single request
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+class WebSeedError(Exception):
+    pass
+
+
+# (scheme, host, port, path) of a web seed url, the path includes the query
+def split_url(url):
+    parts = urllib.parse.urlsplit(url)
+    path = parts.path or "/"
+    if parts.query:
+        path += "?" + parts.query
+    port = parts.port or DEFAULT_PORTS.get(parts.scheme, 80)
+    return parts.scheme, parts.hostname, port, path
+
+
+# the Host header only leaves out the port if it is the scheme's default,
+# virtual hosts on other ports are routed by host:port
+def host_header(scheme, host, port):
+    if ":" in host:
+        host = f"[{host}]"  # IPv6 literal
+    if port == DEFAULT_PORTS.get(scheme):
+        return host
+    return f"{host}:{port}"
+
+
+# keep-alive HTTP connections shared by all workers of a torrent
+class HTTPConnectionPool:
+    def __init__(self):
+        self.idle = {}  # (scheme, host, port) -> [(reader, writer)]
+
+    async def acquire(self, scheme, host, port):
+        connections = self.idle.setdefault((scheme, host, port), [])
+        while connections:
+            reader, writer = connections.pop()
+            if not writer.is_closing() and not reader.at_eof():
+                return reader, writer, True
+            writer.close()
+        reader, writer = await asyncio.open_connection(
+            host, port, ssl=(scheme == "https")
+        )
+        return reader, writer, False
+
+    def release(self, scheme, host, port, reader, writer, reusable):
+        if reusable and not writer.is_closing():
+            self.idle.setdefault((scheme, host, port), []).append((reader, writer))
+        else:
+            writer.close()
+
+    def close(self):
+        for connections in self.idle.values():
+            for _, writer in connections:
+                writer.close()
+        self.idle = {}
+
+
+# downloads pieces from a BEP 19 web seed, one piece at a time, taking
+# part in the piece picker like any other peer
+class WebSeed:
+    def __init__(self, url, torrent, pool, verbose=True):
+        self.url = url
+        self.torrent = torrent
+        self.download_handler = torrent.download_handler
+        self.filewriter = torrent.filewriter
+        self.pool = pool
+        self.verbose = verbose
+        self.waiting = False
+        self.snubbed = False
+        self.stats = PeerStats()
+        self.pending_piece = None
+        # a web seed has every piece
+        self.pieces = range(self.download_handler.tracker.num_pieces)
+        self.failures = 0
+
+        if url.endswith("/"):
+            # single file torrents append the file name to a directory url
+            url += urllib.parse.quote(torrent.tracker.name)
+        self.scheme, self.host, self.port, self.path = split_url(url)
+
+    async def start(self):
+        while True:
+            self.pending_piece = self.download_handler.next(self.pieces, self)
+            if self.pending_piece is None:
+                if self.download_handler.check_done():
+                    return
+                # other peers hold the remaining pieces, one may come back
+                await asyncio.sleep(WEB_SEED_IDLE_INTERVAL)
+                continue
+            self.waiting = True
+            try:
+                await self.download_piece(self.pending_piece)
+                self.failures = 0
+                self.snubbed = False
+            except Exception:
+                if self.verbose:
+                    traceback.print_exc()
+                pretty_print(f"===Web seed {self.url} failed===", "red")
+                self.failures += 1
+                self.snubbed = True
+                self.waiting = False
+                self.download_handler.reissue(self.pending_piece)
+                self.pending_piece = None
+                if self.failures >= WEB_SEED_MAX_FAILURES:
+                    pretty_print(f"===Giving up on web seed {self.url}===", "red")
+                    self.torrent.web_seeds.remove(self)
+                    return
+                await asyncio.sleep(WEB_SEED_RETRY_DELAY * 2 ** (self.failures - 1))
+                continue
+            self.waiting = False
+            if self.download_handler.verify_piece(self.pending_piece):
+                pretty_print(
+                    f"[{self.host}] piece {self.pending_piece.index} from web seed",
+                    "yellow",
+                    end="\r",
+                )
+            self.pending_piece = None
+
+    async def download_piece(self, piece):
+        piece_length = self.download_handler.tracker.piece_length
+        start = piece.index * piece_length + piece.offset
+        end = piece.index * piece_length + piece.length - 1
+        self.stats.record_request()
+        # a stalled mirror must not hold the piece forever, a timeout goes
+        # through the same failure path as any other error
+        data = await asyncio.wait_for(
+            self.fetch(start, end), self.stats.request_timeout()
+        )
+        self.stats.record_block(len(data))
+        self.torrent.downloaded += len(data)
+        with span("hash"):
+            piece.actual_hash.update(data)
+        self.filewriter.write_block(piece.index, piece.offset, data)
+        piece.offset = piece.length
+
+    # fetches bytes start..end (inclusive) of the file with a Range request,
+    # following the mirror if it redirects us somewhere else
+    async def fetch(self, start, end):
+        target = (self.scheme, self.host, self.port, self.path)
+        for _ in range(WEB_SEED_MAX_REDIRECTS + 1):
+            status, headers, body = await self.request(target, start, end)
+            if status in REDIRECT_STATUSES and "location" in headers:
+                base = f"{target[0]}://{host_header(*target[:3])}{target[3]}"
+                location = urllib.parse.urljoin(base, headers["location"])
+                target = split_url(location)
+                if target[0] not in DEFAULT_PORTS:
+                    raise WebSeedError(f"redirected to unsupported url {location}")
+                continue
+            if status != 206:
+                raise WebSeedError(f"expected 206 Partial Content, got {status}")
+            return body
+        raise WebSeedError(f"more than {WEB_SEED_MAX_REDIRECTS} redirects")
+
+    # sends one Range request and returns the status, headers and body
+    async def request(self, target, start, end):
+        scheme, host, port, path = target
+        request = (
+            f"GET {path} HTTP/1.1\r\n"
+            + f"Host: {host_header(scheme, host, port)}\r\n"
+            + f"Range: bytes={start}-{end}\r\n"
+            + "Connection: keep-alive\r\n\r\n"
+        ).encode("utf-8")
+        reader, writer, reused = await self.pool.acquire(scheme, host, port)
+        released = False
+        try:
+            try:
+                writer.write(request)
+                await writer.drain()
+                head = await reader.readuntil(b"\r\n\r\n")
+            except (asyncio.IncompleteReadError, ConnectionError):
+                writer.close()
+                if not reused:
+                    raise
+                # the server closed an idle keep-alive connection, try a new one
+                reader, writer, _ = await self.pool.acquire(scheme, host, port)
+                writer.write(request)
+                await writer.drain()
+                head = await reader.readuntil(b"\r\n\r\n")
+
+            status, headers = self.parse_head(head)
+            length = int(headers.get("content-length", -1))
+            if status == 206 and length != end - start + 1:
+                raise WebSeedError(f"expected {end - start + 1} bytes, got {length}")
+            if length < 0:
+                # no way to find the end of the body, so the connection
+                # can't be reused, e.g. a chunked redirect page
+                return status, headers, b""
+            body = await reader.readexactly(length)
+            reusable = headers.get("connection", "").lower() != "close"
+            self.pool.release(scheme, host, port, reader, writer, reusable)
+            released = True
+        finally:
+            if not released:
+                # failed or timed out half way, the connection is unusable
+                writer.close()
+        return status, headers, body
+
+    def parse_head(self, head):
+        lines = head.decode("latin-1").split("\r\n")
+        status_line = lines[0].split(" ", 2)
+        if len(status_line) < 2 or not status_line[1].isdigit():
+            raise WebSeedError(f"invalid status line {lines[0]!r}")
+        headers = {}
+        for line in lines[1:]:
+            if ":" in line:
+                key, value = line.split(":", 1)
+                headers[key.strip().lower()] = value.strip()
+        return int(status_line[1]), headers